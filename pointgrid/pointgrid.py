@@ -1,7 +1,21 @@
-from scipy.spatial.distance import euclidean
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from numba import njit
 import numpy as np
-import time, base64, math
+import functools, math
+
+# fastmath flags for the search kernels, leaving out the no-inf and no-nan
+# assumptions because filled cells are scored with an infinite distance
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# the number of points slotted per kernel call
+_BATCH_SIZE = 16384
+
+# de Bruijn sequence and lookup table used to find the lowest set bit of a word
+_DEBRUIJN = np.uint64(0x03f79d71b4cb0a89)
+_DEBRUIJN_INDEX = np.zeros(64, dtype=np.int64)
+for _i in range(64):
+  _DEBRUIJN_INDEX[(((1 << _i) * int(_DEBRUIJN)) & 0xffffffffffffffff) >> 58] = _i
 
 def align_points_to_grid(arr,
   fill=0.1,
@@ -9,7 +23,8 @@ def align_points_to_grid(arr,
   optimal_assignments=False,
   log_every=None,
   checkerboard=True,
-  verbose=False):
+  verbose=False,
+  seed=None):
   '''
   Snap each point in `arr` to the closest unoccupied slot in a mesh
   @arg arr numpy.ndarray:
@@ -29,46 +44,88 @@ def align_points_to_grid(arr,
     time to compute
   @kwarg checkerboard bool:
     whether to use checkerboard (True) or square grid (False) pattern
+  @kwarg seed int:
+    seed for the random order in which points are slotted, for reproducible
+    layouts
   @returns numpy.ndarray:
     with shape identical to the shape of `arr`
   '''
   if fill == 0: raise Exception('fill must be greater than 0 and less than 1')
+  arr = np.asarray(arr, dtype=np.float64)
   # create height and width of grid as function of array size and desired fill proportion
   h = w = math.ceil((len(arr)/fill)**(1/2))
+  # the bounds contain every finite point, but a nan or inf point would spoil them
+  finite = np.isfinite(arr).all(axis=1)
+  if not finite.all():
+    px, py = arr[finite.argmin()]
+    raise Exception('Input point is not finite', px, py)
   # find the bounds for the distribution
   bounds = get_bounds(arr, pad=pad)
   # create the grid mesh
-  grid = create_mesh(checkerboard=checkerboard, h=h, w=w, bounds=bounds, verbose=verbose)
+  grid, y_vals, x_vals = create_mesh(checkerboard=checkerboard, h=h, w=w, bounds=bounds, verbose=verbose)
+  # the mesh is uniformly spaced, so a point's row and column follow directly from these steps
+  dy = (bounds[1]-bounds[0])/h
+  dx = (bounds[3]-bounds[2])/w
   # fill the mesh
   if verbose: print(' * filling mesh')
-  df = pd.DataFrame(arr, columns=['x', 'y']).copy(deep=True)
-  # store the number of points slotted
-  c = 0
-  for site, point in df.sample(frac=1)[['x', 'y']].iterrows():
-    # skip points not in original points domain
-    if point.y < bounds[0] or point.y > bounds[1] or \
-       point.x < bounds[2] or point.x > bounds[3]:
-      raise Exception('Input point is out of bounds', point.x, point.y, bounds)
-    # initialize the search radius we'll use to slot this point in an open grid position
-    r_y = (bounds[1]-bounds[0])/h
-    r_x = (bounds[3]-bounds[2])/w
-    slotted = False
-    while not slotted:
-      x, y = _get_grid_location(grid, point, r_x, r_y, optimal_assignments=optimal_assignments)
-      # no open slots were found so increase the search radius
-      if np.isnan(x):
-        r_y *= 2
-        r_x *= 2
-      # success! optionally report the slotted position to the user
-      else:
-        # assign a value other than 1 to mark this slot as filled
-        grid.loc[x, y] = 2
-        df.loc[site, ['y', 'x']] = [x,y]
-        slotted = True
-        c += 1
-        if log_every and c % log_every == 0:
-          print(' * slotted', c, 'of', len(arr), 'assignments')
-  return df.sort_index().to_numpy()
+  # preallocate the output so each assignment is a plain store in original row order
+  out = np.empty(arr.shape, dtype=np.float64)
+  # index the open grid slots so each point's nearest candidates can be found in batch queries
+  slot_y, slot_x = np.nonzero(grid == 1)
+  if len(slot_y) == 0:
+    raise Exception('No open grid positions remain, fill must be lower', fill)
+  tree = cKDTree(np.column_stack([y_vals[slot_y], x_vals[slot_x]]))
+  k = min(8, len(slot_y))
+  # track the open positions as a bitmap that the kernels clear as slots are filled
+  bits = _pack_open(grid)
+  # the slot search runs in float32 on grid-local coordinates, measured in rows and
+  # columns from the grid origin, so float32 precision is relative to the grid size
+  # rather than to the magnitude of the input coordinates. An axis with no extent has
+  # a single coordinate, so its local position is 0 and its weight 0
+  pts = np.empty(arr.shape, dtype=np.float32)
+  pts[:,0] = (arr[:,0] - bounds[2]) / (dx or 1)
+  pts[:,1] = (arr[:,1] - bounds[0]) / (dy or 1)
+  # weight squared row and column offsets by the squared spacings, so distances stay Euclidean
+  step = max(dx, dy) or 1
+  weights = (np.float32((dy / step)**2), np.float32((dx / step)**2))
+  # slot the points in a random order, in batches of candidate queries
+  order = np.arange(len(arr))
+  np.random.default_rng(seed).shuffle(order)
+  batches = np.split(order, np.arange(_BATCH_SIZE, len(arr), _BATCH_SIZE))
+  if log_every:
+    if int(log_every) < 1: raise Exception('log_every must be a positive integer', log_every)
+    log_every = int(log_every)
+  def query(sites):
+    _, candidates = tree.query(arr[sites][:, ::-1], k=k)
+    candidates = candidates.reshape(len(sites), -1)
+    return slot_y[candidates], slot_x[candidates]
+  align_points = _slotting_kernel(bool(optimal_assignments))
+  start = 0
+  def slot(sites, cand_y, cand_x):
+    nonlocal start
+    # slot the batch in pieces that end where progress should be reported
+    cuts = np.arange(log_every - start % log_every, len(sites), log_every) if log_every else []
+    for s, y, x in zip(np.split(sites, cuts), np.split(cand_y, cuts), np.split(cand_x, cuts)):
+      c = align_points(pts, s, bits, y_vals, x_vals, weights, y, x, out)
+      if c < len(s):
+        raise Exception('No open grid positions remain, fill must be lower', fill)
+      start += c
+      # optionally report the slotted positions to the user
+      if log_every and start % log_every == 0:
+        print(' * slotted', start, 'of', len(arr), 'assignments')
+  if len(batches) == 1:
+    slot(batches[0], *query(batches[0]))
+    return out
+  # the kernels release the GIL, so query the next batch's candidates on a worker
+  # thread while the current batch is slotted
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    pending = executor.submit(query, batches[0])
+    for i, sites in enumerate(batches):
+      cand_y, cand_x = pending.result()
+      if i + 1 < len(batches):
+        pending = executor.submit(query, batches[i+1])
+      slot(sites, cand_y, cand_x)
+  return out
 
 def get_bounds(arr, pad=0.2):
   '''
@@ -81,13 +138,15 @@ def get_bounds(arr, pad=0.2):
   @returns list
     a list with [y_min, y_max, x_min, x_max]
   '''
-  x_dom = [np.min(arr[:,1]), np.max(arr[:,1])]
-  y_dom = [np.min(arr[:,0]), np.max(arr[:,0])]
+  # reduce both columns at once rather than scanning the array once per bound
+  lo = arr.min(axis=0)
+  hi = arr.max(axis=0)
+  span = np.abs((hi - lo) * pad)
   return [
-    x_dom[0] - np.abs((x_dom[1]-x_dom[0])*pad),
-    x_dom[1] + np.abs((x_dom[1]-x_dom[0])*pad),
-    y_dom[0] - np.abs((y_dom[1]-y_dom[0])*pad),
-    y_dom[1] + np.abs((y_dom[1]-y_dom[0])*pad),
+    lo[1] - span[1],
+    hi[1] + span[1],
+    lo[0] - span[0],
+    hi[0] + span[0],
   ]
 
 def create_mesh(h=100, w=100, bounds=[], checkerboard=True, verbose=False):
@@ -101,64 +160,296 @@ def create_mesh(h=100, w=100, bounds=[], checkerboard=True, verbose=False):
     a list with [y_min, y_max, x_min, x_max]
   @kwarg checkerboard bool:
     whether to use checkerboard (True) or square grid (False) pattern
-  @returns pandas.core.frame.DataFrame
-     dataframe containing the available grid positions
+  @returns tuple
+    a tuple (grid, y_vals, x_vals) where grid is a numpy.ndarray of uint8
+    with shape (len(y_vals), len(x_vals)) whose open positions are 1, and
+    y_vals and x_vals are the coordinates of the grid rows and columns
   '''
   if verbose: print(' * creating mesh with size', h, w)
   # create array of valid positions
-  y_vals = np.arange(bounds[0], bounds[1], (bounds[1]-bounds[0])/h)
-  x_vals = np.arange(bounds[2], bounds[3], (bounds[3]-bounds[2])/w)
-  # create the dense mesh
+  y_vals = bounds[0] + np.arange(h) * ((bounds[1]-bounds[0])/h)
+  x_vals = bounds[2] + np.arange(w) * ((bounds[3]-bounds[2])/w)
+  # create the dense mesh, where checkerboard slots are open when row + column is odd
   if checkerboard:
-    data = np.tile(
-      [[0, 1], [1, 0]],
-      np.array([
-        int(np.ceil(len(y_vals) / 2)),
-        int(np.ceil(len(x_vals) / 2)),
-      ]))
+    row_parity = (np.arange(len(y_vals)) & 1).astype(np.uint8)
+    col_parity = (np.arange(len(x_vals)) & 1).astype(np.uint8)
+    data = row_parity[:,None] ^ col_parity[None,:]
   else:
-    data = np.ones((len(y_vals), len(x_vals)), dtype=np.int32)
-  # ensure each axis has an even number of slots
-  if len(y_vals) % 2 != 0 or len(x_vals) % 2 != 0:
-    data = data[0:len(y_vals), 0:len(x_vals)]
-  return pd.DataFrame(data, index=y_vals, columns=x_vals)
+    data = np.ones((len(y_vals), len(x_vals)), dtype=np.uint8)
+  return data, y_vals, x_vals
 
-def _get_grid_location(grid, point, r_x, r_y, optimal_assignments=False):
-  '''
-  Find the x,y positions in `grid` to which `point` should be assigned
-  @arg grid pandas.core.frame.DataFrame:
-    dataframe containing the available grid positions
-  @arg point tuple:
-    a row from `grid` with x, y attributes
-  @arg r_x float:
-    the search radius to use in the x direction
-  @arg r_y float:
-    the search radius to use in the y direction
-  @kwarg optimal_assignments bool:
+@functools.lru_cache(maxsize=None)
+def _slotting_kernel(optimal_assignments):
+  '''
+  Return `_align_points` specialized for one assignment mode
+  @arg optimal_assignments bool:
+    the assignment mode to specialize for
+  @returns function
+    a compiled function that takes the arguments of `_align_points` except
+    `optimal_assignments`
+  '''
+  # the closure passes the mode as a compile time constant, so numba types it as a
+  # literal down the call chain and the other mode's branches fold away
+  @njit(cache=True, nogil=True, fastmath=_FASTMATH)
+  def align_points(arr, sites, bits, y_vals, x_vals, weights, cand_y, cand_x, out):
+    return _align_points(arr, sites, bits, y_vals, x_vals, weights, cand_y, cand_x, optimal_assignments, out)
+  return align_points
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH)
+def _align_points(arr, sites, bits, y_vals, x_vals, weights, cand_y, cand_x, optimal_assignments, out):
+  '''
+  Snap the points in `arr` at the indices `sites` to open slots in `bits`, in order
+  @arg arr numpy.ndarray:
+    a float32 array with shape (n,2) of grid-local (column, row) point
+    positions, all of which lie within the grid
+  @arg sites numpy.ndarray:
+    the indices of the points in `arr` to slot
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg y_vals numpy.ndarray:
+    the coordinates of the grid rows, written to `out`
+  @arg x_vals numpy.ndarray:
+    the coordinates of the grid columns, written to `out`
+  @arg weights tuple:
+    the (row, column) weights of squared grid-local offsets, proportional to
+    the squared row and column spacings
+  @arg cand_y numpy.ndarray:
+    array with shape (len(sites),k) of the rows of each site's nearest slots
+  @arg cand_x numpy.ndarray:
+    array with shape (len(sites),k) of the columns of each site's nearest slots
+  @arg optimal_assignments bool:
+    if True assigns each point to its closest open grid point, otherwise an
+    approximately optimal open grid point is selected
+  @arg out numpy.ndarray:
+    array with shape (n,2) that receives the slotted positions
+  @returns int
+    the number of sites slotted, which is less than len(sites) if no open
+    grid positions remain
+  '''
+  for n in range(len(sites)):
+    site = sites[n]
+    px, py = arr[site, 0], arr[site, 1]
+    # candidates are sorted by distance, so the first open one is the closest open slot
+    iy, ix = -1, -1
+    for k in range(cand_y.shape[1]):
+      if _is_open(bits, cand_y[n, k], cand_x[n, k]):
+        iy, ix = cand_y[n, k], cand_x[n, k]
+        break
+    # all candidates are filled so search successively larger windows for an open slot
+    if iy < 0:
+      iy, ix = _find_slot(bits, len(y_vals), len(x_vals), weights, py, px, optimal_assignments)
+      if iy < 0:
+        return n
+    # clear this slot's bit to mark it as filled
+    bits[iy, ix >> 6] &= ~(np.uint64(1) << np.uint64(ix & 63))
+    out[site, 0] = x_vals[ix]
+    out[site, 1] = y_vals[iy]
+  return len(sites)
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH)
+def _find_slot(bits, h, w, weights, py, px, optimal_assignments):
+  '''
+  Find the row and column positions in `bits` to which a point should be assigned
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg h int:
+    the number of grid rows
+  @arg w int:
+    the number of grid columns
+  @arg weights tuple:
+    the (row, column) weights of squared grid-local offsets, proportional to
+    the squared row and column spacings
+  @arg py float:
+    the grid-local row position of the point to assign
+  @arg px float:
+    the grid-local column position of the point to assign
+  @arg optimal_assignments bool:
     if True assigns each point to its closest open grid point, otherwise an
     approximately optimal open grid point is selected. True requires more
     time to compute
-  @returns list
-    the ideal [x,y] positions for `point` in `grid` if found, else
-    [np.nan, np.nan]
-  '''
-  bottom = grid.index.searchsorted(point.y - r_y)
-  top = grid.index.searchsorted(point.y + r_y, side='right')
-  left = grid.columns.searchsorted(point.x - r_x)
-  right = grid.columns.searchsorted(point.x + r_x, side='right')
-  close_grid_points = grid.iloc[bottom:top, left:right]
-  # if using optimal_assignments, store the position in this point's radius that minimizes distortion
-  # else return the first open position within this point's current radius r_x, r_y
-  best_dist = np.inf
-  grid_loc = [np.nan, np.nan]
-  for x, col in close_grid_points.iterrows():
-    for y, val in col.items():
-      if val != 1: continue
-      if not optimal_assignments:
-        return [x, y]
-      else:
-        dist = euclidean(point, (x,y))
-        if dist < best_dist:
-          best_dist = dist
-          grid_loc = [x,y]
-  return grid_loc
\ No newline at end of file
+  @returns tuple
+    the ideal (row, column) indices for the point in `bits` if found, else
+    (-1, -1) if the grid has no open positions
+  '''
+  iy = min(h - 1, int(py + 0.5))
+  ix = min(w - 1, int(px + 0.5))
+  # the window searched so far, which starts out empty at the point's nearest slot
+  bottom, top, left, right = iy, iy, ix, ix
+  best = (np.inf, -1, -1)
+  half = 1
+  while True:
+    new_bottom = max(0, iy - half)
+    new_top = min(h, iy + half + 1)
+    new_left = max(0, ix - half)
+    new_right = min(w, ix + half + 1)
+    # the inner window held no open positions, so only scan the ring around it
+    best = _scan_block(bits, weights, py, px, new_bottom, bottom, new_left, new_right, optimal_assignments, best)
+    best = _scan_block(bits, weights, py, px, top, new_top, new_left, new_right, optimal_assignments, best)
+    best = _scan_block(bits, weights, py, px, bottom, top, new_left, left, optimal_assignments, best)
+    best = _scan_block(bits, weights, py, px, bottom, top, right, new_right, optimal_assignments, best)
+    if best[1] >= 0:
+      return best[1], best[2]
+    if new_bottom == 0 and new_top == h and new_left == 0 and new_right == w:
+      return -1, -1
+    # no open slots were found so increase the search radius
+    bottom, top, left, right = new_bottom, new_top, new_left, new_right
+    half *= 2
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH)
+def _scan_block(bits, weights, py, px, bottom, top, left, right, optimal_assignments, best):
+  '''
+  Search the block [bottom:top, left:right] of `bits` for an open position
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg weights tuple:
+    the (row, column) weights of squared grid-local offsets, proportional to
+    the squared row and column spacings
+  @arg py float:
+    the grid-local row position of the point to assign
+  @arg px float:
+    the grid-local column position of the point to assign
+  @arg bottom int:
+    the first row of the block
+  @arg top int:
+    the row after the last row of the block
+  @arg left int:
+    the first column of the block
+  @arg right int:
+    the column after the last column of the block
+  @arg optimal_assignments bool:
+    if True returns the open position closest to the point, otherwise the
+    first open position in the block
+  @arg best tuple:
+    the (squared distance, row, column) of the best open position found so
+    far, with row -1 if none has been found
+  @returns tuple
+    the updated (squared distance, row, column) of the best open position
+  '''
+  if right <= left:
+    return best
+  # if not using optimal_assignments, return the first open position in the block
+  if not optimal_assignments:
+    if best[1] >= 0:
+      return best
+    for i in range(bottom, top):
+      for w in range(left >> 6, ((right - 1) >> 6) + 1):
+        word = _open_bits(bits, i, w, left, right)
+        if word:
+          return 0.0, i, (w << 6) + _lowest_bit(word)
+    return best
+  # else store the position in the block that minimizes distortion, visiting only the
+  # open positions of each word. Squared distances preserve the argmin
+  best_dist, best_i, best_j = best
+  for i in range(bottom, top):
+    dist, j = _best_in_row(bits, weights, py, px, i, left, right)
+    if dist < best_dist:
+      best_dist, best_i, best_j = dist, i, j
+  return best_dist, best_i, best_j
+
+@njit(cache=True, nogil=True, fastmath=_FASTMATH)
+def _best_in_row(bits, weights, py, px, i, left, right):
+  '''
+  Find the open position in row `i` of `bits` between columns [left, right)
+  closest to a point
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg weights tuple:
+    the (row, column) weights of squared grid-local offsets, proportional to
+    the squared row and column spacings
+  @arg py float:
+    the grid-local row position of the point to assign
+  @arg px float:
+    the grid-local column position of the point to assign
+  @arg i int:
+    the row to search
+  @arg left int:
+    the first column to search
+  @arg right int:
+    the column after the last column to search
+  @returns tuple
+    the (squared distance, column) of the closest open position, with
+    distance inf if the row has no open positions in range
+  '''
+  d = np.float32(i) - py
+  dy2 = weights[0] * d * d
+  best_dist, best_j = np.float32(np.inf), -1
+  for w in range(left >> 6, ((right - 1) >> 6) + 1):
+    word = _open_bits(bits, i, w, left, right)
+    while word:
+      j = (w << 6) + _lowest_bit(word)
+      d = np.float32(j) - px
+      dist = dy2 + weights[1] * d * d
+      if dist < best_dist:
+        best_dist, best_j = dist, j
+      # clear the lowest set bit
+      word &= word - np.uint64(1)
+  return best_dist, best_j
+
+@njit(cache=True, nogil=True)
+def _is_open(bits, i, j):
+  '''
+  Return True if the position at row `i`, column `j` of `bits` is open
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg i int:
+    the row of the position
+  @arg j int:
+    the column of the position
+  @returns bool
+    True if the bit for the position is set
+  '''
+  return (bits[i, j >> 6] >> np.uint64(j & 63)) & np.uint64(1) != 0
+
+@njit(cache=True, nogil=True)
+def _open_bits(bits, i, w, left, right):
+  '''
+  Return word `w` of row `i` of `bits` with the bits for columns outside
+  [left, right) cleared
+  @arg bits numpy.ndarray:
+    uint64 bitmap of the open grid positions, see `_pack_open`
+  @arg i int:
+    the row of the word
+  @arg w int:
+    the index of the word within the row
+  @arg left int:
+    the first column to keep
+  @arg right int:
+    the column after the last column to keep
+  @returns numpy.uint64
+    the masked word, whose set bits are the open positions in range
+  '''
+  word = bits[i, w]
+  lo = left - (w << 6)
+  hi = right - (w << 6)
+  if lo > 0:
+    word &= ~((np.uint64(1) << np.uint64(lo)) - np.uint64(1))
+  if hi < 64:
+    word &= (np.uint64(1) << np.uint64(hi)) - np.uint64(1)
+  return word
+
+@njit(cache=True, nogil=True)
+def _lowest_bit(word):
+  '''
+  Return the index of the lowest set bit in the nonzero uint64 `word`
+  @arg word numpy.uint64:
+    the word to search, which must have at least one bit set
+  @returns int
+    the index 0:63 of the lowest set bit
+  '''
+  # isolate the lowest set bit, then a de Bruijn multiply maps it to a unique table slot
+  low = word & (~word + np.uint64(1))
+  return _DEBRUIJN_INDEX[(low * _DEBRUIJN) >> np.uint64(58)]
+
+def _pack_open(grid):
+  '''
+  Pack the open positions of a mesh into a bitmap
+  @arg grid numpy.ndarray:
+    uint8 array containing the available grid positions
+  @returns numpy.ndarray
+    uint64 array with shape (h, ceil(w/64)) where bit j % 64 of word j // 64
+    in row i is set if grid[i, j] is open
+  '''
+  packed = np.packbits(grid == 1, axis=1, bitorder='little')
+  words = np.zeros((grid.shape[0], -(-grid.shape[1] // 64) * 8), dtype=np.uint8)
+  words[:, :packed.shape[1]] = packed
+  return words.view('<u8').astype(np.uint64, copy=False)
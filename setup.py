@@ -11,8 +11,8 @@ setup (
   author_email='douglas.duhaime@gmail.com',
   license='MIT',
   install_requires=[
-    'numpy>=1.14.0',
-    'pandas>=0.25.3',
+    'numba>=0.49.0',
+    'numpy>=1.17.0',
     'scipy>=1.1.0'
   ],
 )
\ No newline at end of file